@@ -4,112 +4,99 @@ TradingView Screener - Pre-filters stocks for StrategyForge strategies.
 Runs via GitHub Actions cron, writes results to Neon PostgreSQL.
 """
 
+import csv
+import io
+import operator
 import os
-import json
-import math
+from collections import Counter
+from collections.abc import Iterable, Iterator
 from datetime import datetime
+import numpy as np
+import orjson
+import pandas as pd
 import psycopg2
-from tradingview_screener import Query, col
+from tradingview_screener import And, Or, Query, col
 
 
-def clean_for_json(obj):
-    """Replace NaN/Inf values with None for JSON serialization."""
-    if isinstance(obj, dict):
-        return {k: clean_for_json(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [clean_for_json(v) for v in obj]
-    elif isinstance(obj, float):
-        if math.isnan(obj) or math.isinf(obj):
-            return None
-        return obj
-    return obj
-
 DATABASE_URL = os.environ.get('DATABASE_URL', '').strip().strip('"').strip("'")
 
+# Universal gate applied to every strategy: tradeable price range and liquidity
+BASE_FILTERS = (
+    col('close').between(25, 100),
+    col('close').not_empty(),
+    col('volume') > 500000,
+)
+
 # Strategy filter configurations
 # Each strategy has specific indicator requirements for pre-filtering
+# (only the differentiating conditions - BASE_FILTERS are added by run_screener)
 STRATEGY_FILTERS = {
     'rsi_stochastic_oversold': {
         'name': 'RSI-Stochastic Double Oversold',
         'filters': [
-            col('close').between(25, 100),
             col('RSI') < 40,  # Slightly relaxed from 35
             col('Stoch.K') < 30,  # Slightly relaxed from 25
             col('MACD.macd') > col('MACD.signal'),  # MACD bullish
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'RSI', 'Stoch.K', 'Stoch.D', 'MACD.macd', 'MACD.signal', 'volume', 'change']
     },
     'adx_trend_pullback': {
         'name': 'ADX Trend + MA Pullback',
         'filters': [
-            col('close').between(25, 100),
             col('ADX') > 20,  # Relaxed from 25
             col('ADX+DI') > col('ADX-DI'),  # Bullish DI
             col('close') > col('SMA50'),  # Above 50 MA (trend)
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'ADX', 'ADX+DI', 'ADX-DI', 'SMA20', 'SMA50', 'volume', 'change']
     },
     'bollinger_squeeze': {
         'name': 'Bollinger Squeeze Breakout',
         'filters': [
-            col('close').between(25, 100),
             col('Volatility.D') < 5,  # Low volatility
             col('close') > col('BB.upper'),  # Breaking out above upper band
             col('Mom') > 0,  # Positive momentum
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'BB.upper', 'BB.lower', 'Volatility.D', 'Mom', 'volume', 'change']
     },
     'macd_bb_volume': {
         'name': 'MACD-BB-Volume Triple Filter',
         'filters': [
-            col('close').between(25, 100),
             col('MACD.macd') > col('MACD.signal'),  # MACD bullish
             col('close') > col('SMA20'),  # Above 20 SMA (proxy for middle BB)
             col('RSI').between(40, 70),  # Healthy RSI range
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'MACD.macd', 'MACD.signal', 'SMA20', 'RSI', 'volume', 'change']
     },
     'stochastic_rsi_sync': {
         'name': 'Stochastic-RSI Momentum Sync',
         'filters': [
-            col('close').between(25, 100),
             col('Stoch.K') > col('Stoch.D'),  # Stochastic bullish cross
             col('RSI').between(30, 55),  # Recovering from oversold
             col('close') > col('SMA50'),  # Uptrend filter
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'Stoch.K', 'Stoch.D', 'RSI', 'SMA50', 'volume', 'change']
     },
     'rsi_mean_reversion': {
         'name': 'RSI Mean Reversion',
         'filters': [
-            col('close').between(25, 100),
             col('RSI') < 35,  # Oversold
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'RSI', 'volume', 'change']
     },
     'macd_momentum': {
         'name': 'MACD Momentum Crossover',
         'filters': [
-            col('close').between(25, 100),
             col('MACD.macd') > col('MACD.signal'),  # Bullish crossover
             col('close') > col('SMA50'),  # Above 50 MA
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'MACD.macd', 'MACD.signal', 'SMA50', 'volume', 'change']
     },
     'volume_breakout': {
         'name': 'Volume Breakout Scanner',
         'filters': [
-            col('close').between(25, 100),
             col('relative_volume_10d_calc') > 2.0,  # 2x average volume
             col('High.All') > 0,  # Has 52-week high data
-            col('volume') > 1000000,
+            col('volume') > 1000000,  # Stricter than the base volume gate
         ],
         'columns': ['name', 'close', 'relative_volume_10d_calc', 'High.All', 'volume', 'change']
     },
@@ -117,166 +104,266 @@ STRATEGY_FILTERS = {
     '52_week_high_breakout': {
         'name': '52-Week High Breakout',
         'filters': [
-            col('close').between(25, 100),
             col('close') > col('SMA50'),  # Above 50 MA (trending up)
             col('close') > col('SMA200'),  # Above 200 MA (long-term uptrend)
             col('change') > 1,  # Up today (momentum)
             col('relative_volume_10d_calc') > 1.5,  # Volume spike
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'High.All', 'SMA50', 'SMA200', 'relative_volume_10d_calc', 'volume', 'change']
     },
     'adx_trend_rider': {
         'name': 'ADX Trend Rider',
         'filters': [
-            col('close').between(25, 100),
             col('ADX') > 25,  # Strong trend
             col('ADX+DI') > col('ADX-DI'),  # Bullish direction
             col('close') > col('SMA50'),  # Above 50 MA
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'ADX', 'ADX+DI', 'ADX-DI', 'SMA50', 'volume', 'change']
     },
     'triple_ma_trend': {
         'name': 'Triple MA Trend',
         'filters': [
-            col('close').between(25, 100),
             col('close') > col('SMA20'),  # Price above 20 MA
             col('SMA20') > col('SMA50'),  # 20 MA above 50 MA (aligned trend)
             col('MACD.macd') > col('MACD.signal'),  # MACD bullish
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'SMA20', 'SMA50', 'MACD.macd', 'MACD.signal', 'volume', 'change']
     },
     'momentum_persistence': {
         'name': 'Momentum Persistence',
         'filters': [
-            col('close').between(25, 100),
             col('change') > 3,  # Up more than 3% today (momentum)
             col('close') > col('SMA200'),  # Above 200 MA (long-term uptrend)
             col('relative_volume_10d_calc') > 1.2,  # Above average volume
-            col('volume') > 500000,
         ],
         'columns': ['name', 'close', 'SMA200', 'change', 'relative_volume_10d_calc', 'volume']
     },
 }
 
+# Indicator columns stored with each signal, resolved once per strategy.
+# get_scanner_data() always prepends a 'ticker' column to the selection.
+for _config in STRATEGY_FILTERS.values():
+    _config['_indicator_cols'] = ['ticker', *(c for c in _config['columns'] if c != 'name')]
+
+# All strategies are fetched in one scan, so select the union of their columns
+SCAN_COLUMNS = list(dict.fromkeys(c for config in STRATEGY_FILTERS.values() for c in config['columns']))
+
+STRATEGY_LIMIT = 100  # Top 100 matches per strategy
+SCAN_LIMIT = 5000  # Enough to cover the whole base-filtered universe
+
+_COMPARISONS = {
+    'greater': operator.gt,
+    'egreater': operator.ge,
+    'less': operator.lt,
+    'eless': operator.le,
+    'equal': operator.eq,
+    'nequal': operator.ne,
+}
+
+
+def filter_mask(filter_cond: dict, frame: pd.DataFrame) -> np.ndarray:
+    """Evaluate a TradingView filter over every row of a numeric frame at once."""
+    left = frame[filter_cond['left']]
+    operation = filter_cond['operation']
+    right = filter_cond['right']
 
-def run_screener(strategy_key: str, strategy_config: dict) -> list:
-    """Run TradingView screener for a specific strategy."""
+    # NaN compares False, matching how the screener treats missing values
+    if operation == 'nempty':
+        return left.notna().to_numpy()
+    if operation == 'in_range':
+        low, high = right
+        return left.between(low, high).to_numpy()
+    if operation not in _COMPARISONS:
+        raise ValueError(f"Unsupported filter operation: {operation}")
+
+    other = frame[right] if isinstance(right, str) else right  # Column-to-column comparison
+    return _COMPARISONS[operation](left, other).to_numpy()
+
+
+def run_screener() -> pd.DataFrame | None:
+    """Run one TradingView scan matching any strategy's filters."""
     try:
-        query = Query().select(*strategy_config['columns']).set_markets('america')
+        query = Query().select(*SCAN_COLUMNS).set_markets('america')
+
+        # where() replaces the filter list, so all conditions go in one call
+        query = query.where(*BASE_FILTERS)
 
-        for filter_cond in strategy_config['filters']:
-            query = query.where(filter_cond)
+        # where2() replaces the default stock-type filter, so keep it alongside
+        # (strategy 1 OR strategy 2 OR ...)
+        default_types = {'operation': query.query['filter2']}
+        query = query.where2(And(
+            default_types,
+            Or(*(And(*config['filters']) for config in STRATEGY_FILTERS.values())),
+        ))
 
-        query = query.limit(100)  # Top 100 matches per strategy
+        query = query.limit(SCAN_LIMIT)
 
         count, results = query.get_scanner_data()
 
-        print(f"  {strategy_config['name']}: {count} total matches, returning top {len(results)}")
+        print(f"  {count} total matches across all strategies, returning {len(results)}")
+        if results.empty:
+            return None
 
-        return results.to_dict('records') if len(results) > 0 else []
+        # Treat Inf like a missing value
+        return results.replace([np.inf, -np.inf], np.nan)
     except Exception as e:
-        print(f"  Error running screener for {strategy_key}: {e}")
-        return []
+        print(f"  Error running screener: {e}")
+        return None
 
 
-def save_to_database(signals: list):
+def save_to_database(signals: Iterable[tuple]):
     """Save screener signals to Neon PostgreSQL."""
+    # Stream rows into CSV for COPY (None is written as an empty field, i.e. NULL)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    total = 0
+    for symbol, strategy_key, strategy_name, price, indicators in signals:
+        # COPY takes text, so serialize here (orjson also passes NumPy scalars through)
+        writer.writerow((
+            symbol,
+            strategy_key,
+            strategy_name,
+            price,
+            orjson.dumps(indicators, option=orjson.OPT_SERIALIZE_NUMPY).decode(),
+        ))
+        total += 1
+
+    if not total:
+        return
     if not DATABASE_URL:
         print("ERROR: DATABASE_URL not set")
         return
-
-    conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = True  # Each insert is its own transaction
-    cur = conn.cursor()
-
-    # Table is managed by Prisma - just clear old signals
+    buffer.seek(0)
+
+    # Single connection for the whole run; keepalives stop Neon's pooler from
+    # dropping it while the batch is staged
+    conn = psycopg2.connect(
+        DATABASE_URL,
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
+        application_name='sf-screener',
+    )
     try:
-        cur.execute("""
-            DELETE FROM "ScreenerSignal"
-            WHERE scanned_at < NOW() - INTERVAL '1 day'
-        """)
-    except Exception as e:
-        print(f"  Error clearing old signals: {e}")
-
-    # Insert or update signals (upsert on symbol+strategy_key)
-    saved_count = 0
-    for signal in signals:
-        try:
-            # Clean indicators of NaN values
-            clean_indicators = clean_for_json(signal['indicators'])
-
+        # One transaction for the cleanup and the whole batch
+        with conn, conn.cursor() as cur:
+            # Table is managed by Prisma - just clear old signals. Sent in the
+            # same round-trip as the staging table setup.
+            cur.execute("""
+                DELETE FROM "ScreenerSignal"
+                WHERE scanned_at < NOW() - INTERVAL '1 day';
+
+                CREATE TEMP TABLE screener_signal_staging (
+                    symbol text,
+                    strategy_key text,
+                    strategy_name text,
+                    price double precision,
+                    indicators jsonb
+                ) ON COMMIT DROP
+            """)
+            cur.copy_expert("COPY screener_signal_staging FROM STDIN WITH (FORMAT csv)", buffer)
+
+            # Insert or update signals (upsert on symbol+strategy_key).
+            # Unchanged pending signals are left alone to avoid rewriting the row.
             cur.execute("""
                 INSERT INTO "ScreenerSignal" (symbol, strategy_key, strategy_name, price, indicators, scanned_at, processed)
-                VALUES (%s, %s, %s, %s, %s, NOW(), FALSE)
+                SELECT symbol, strategy_key, strategy_name, price, indicators, NOW(), FALSE
+                FROM screener_signal_staging
                 ON CONFLICT (symbol, strategy_key) DO UPDATE SET
                     price = EXCLUDED.price,
                     indicators = EXCLUDED.indicators,
                     scanned_at = NOW(),
                     processed = FALSE
                 WHERE "ScreenerSignal".processed = FALSE
-            """, (
-                signal['symbol'],
-                signal['strategy_key'],
-                signal['strategy_name'],
-                signal['price'],
-                json.dumps(clean_indicators)
-            ))
-            saved_count += 1
-        except Exception as e:
-            print(f"  Error saving {signal['symbol']}: {e}")
+                  AND ("ScreenerSignal".price, "ScreenerSignal".indicators)
+                      IS DISTINCT FROM (EXCLUDED.price, EXCLUDED.indicators)
+            """)
+            written = cur.rowcount
+    except Exception as e:
+        print(f"  Error saving signals: {e}")
+        return
+    finally:
+        conn.close()
+
+    print(f"Saved {written}/{total} signals to database ({total - written} unchanged or already processed)")
+
 
-    cur.close()
-    conn.close()
+def scan_signals(counts: Counter) -> Iterator[tuple]:
+    """
+    Yield (symbol, strategy_key, strategy_name, price, indicators) for each screener hit.
+    counts is updated with the number of signals yielded per strategy.
+    """
+    results = run_screener()
+    if results is None:
+        return
 
-    print(f"Saved {saved_count}/{len(signals)} signals to database")
+    # Tag rows with strategies using vectorized filter evaluation:
+    # matches[i, j] is True when row i passes every filter of strategy j
+    numeric = results.drop(columns=['ticker', 'name']).apply(pd.to_numeric, errors='coerce')
+    matches = np.column_stack([
+        np.logical_and.reduce([filter_mask(f, numeric) for f in strategy_config['filters']])
+        for strategy_config in STRATEGY_FILTERS.values()
+    ])
+    # Rows need a symbol and a price; only NaN prices can slip past the server-side range
+    matches &= (results['name'].fillna('').astype(bool) & results['close'].notna()).to_numpy()[:, None]
+
+    # Replace NaN with None for JSON serialization and read rows as plain tuples
+    results = results.astype(object).where(results.notna(), None)
+    rows = list(results.itertuples(index=False, name=None))
+    columns = results.columns
+    name_pos = columns.get_loc('name')
+    close_pos = columns.get_loc('close')
+    strategies = [
+        (
+            strategy_key,
+            strategy_config,
+            [(c, columns.get_loc(c)) for c in strategy_config['_indicator_cols']],
+        )
+        for strategy_key, strategy_config in STRATEGY_FILTERS.items()
+    ]
+    # A single upsert statement cannot touch the same row twice, so keep only
+    # the first listing of a symbol (results are ordered by market cap)
+    seen = set()
+
+    # Row-major order keeps market-cap ranking within each strategy
+    for i, j in zip(*np.nonzero(matches)):
+        strategy_key, strategy_config, indicator_pos = strategies[j]
+        row = rows[i]
+        symbol = row[name_pos].rpartition(':')[2]  # Extract symbol from "NASDAQ:AAPL"
+
+        if counts[strategy_key] >= STRATEGY_LIMIT or (symbol, strategy_key) in seen:
+            continue
+        seen.add((symbol, strategy_key))
+        counts[strategy_key] += 1
+
+        yield (
+            symbol,
+            strategy_key,
+            strategy_config['name'],
+            row[close_pos],
+            {c: row[pos] for c, pos in indicator_pos},
+        )
 
 
 def main():
     print(f"TradingView Screener - {datetime.now().isoformat()}")
     print("=" * 50)
 
-    all_signals = []
-
-    for strategy_key, strategy_config in STRATEGY_FILTERS.items():
-        print(f"\nScanning: {strategy_config['name']}")
-
-        results = run_screener(strategy_key, strategy_config)
+    counts = Counter()  # Signals per strategy, filled in as the scan is consumed
 
-        for row in results:
-            symbol = row.get('name', '').split(':')[-1]  # Extract symbol from "NASDAQ:AAPL"
-            if not symbol:
-                continue
+    print(f"\nScanning {len(STRATEGY_FILTERS)} strategies")
 
-            # Extract price and other indicators
-            indicators = {k: v for k, v in row.items() if k != 'name'}
-            price = row.get('close', 0)
-
-            # Double-check price is in valid range (TradingView filter sometimes fails)
-            if not price or price < 25 or price > 100:
-                continue
-
-            all_signals.append({
-                'symbol': symbol,
-                'strategy_key': strategy_key,
-                'strategy_name': strategy_config['name'],
-                'price': price,
-                'indicators': indicators,
-            })
+    # Signals stream straight from the scan into the database load
+    save_to_database(scan_signals(counts))
 
     print(f"\n{'=' * 50}")
-    print(f"Total signals found: {len(all_signals)}")
-
-    if all_signals:
-        save_to_database(all_signals)
+    print(f"Total signals found: {counts.total()}")
 
     # Print summary by strategy
     print("\nSummary by strategy:")
-    for strategy_key in STRATEGY_FILTERS:
-        count = len([s for s in all_signals if s['strategy_key'] == strategy_key])
-        print(f"  {STRATEGY_FILTERS[strategy_key]['name']}: {count} signals")
+    for strategy_key, strategy_config in STRATEGY_FILTERS.items():
+        print(f"  {strategy_config['name']}: {counts[strategy_key]} signals")
 
 
 if __name__ == '__main__':